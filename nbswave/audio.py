@@ -1,8 +1,16 @@
+import logging
 import math
-from typing import Dict, Optional
+import os
+import subprocess
+import sys
+from collections import defaultdict
+from typing import Dict, Optional, Sequence, Tuple
 
 import numpy as np
 from pydub import AudioSegment
+from pydub.exceptions import CouldntEncodeError
+
+logger = logging.getLogger(__name__)
 
 
 def load_sound(path: str) -> AudioSegment:
@@ -22,21 +30,96 @@ def sync(
     )
 
 
+def get_samples(sound: AudioSegment) -> np.ndarray:
+    """Return a read-only view of the samples in `sound`, shaped (frames, channels)."""
+    samples = np.frombuffer(sound.raw_data, dtype=sound.array_type)
+    return samples.reshape(-1, sound.channels)
+
+
+def resample(samples: np.ndarray, speed: float) -> np.ndarray:
+    """Return `samples`, shaped (frames, channels), played back `speed` times faster,
+    using linear interpolation between the original frames. Interpolated samples
+    are returned as float32, which is precise enough for 16-bit sounds."""
+    if abs(speed - 1.0) < 1e-6:
+        return samples
+
+    frame_count = len(samples)
+    new_frame_count = round(frame_count / speed)
+
+    # Whole-number speeds (such as octaves up) land exactly on the original
+    # frames, so no interpolation is needed
+    if speed == round(speed):
+        return samples[:: round(speed)][:new_frame_count]
+
+    positions = np.arange(new_frame_count) * speed
+    frames = np.arange(frame_count)
+    resampled = np.empty((new_frame_count, samples.shape[1]), dtype="float32")
+    for channel in range(samples.shape[1]):
+        resampled[:, channel] = np.interp(positions, frames, samples[:, channel])
+    return resampled
+
+
+def get_pan_gains(pan: float) -> Tuple[float, float]:
+    """Return the (left, right) gain factors for a panning value between -1 and 1,
+    following the same pan law as `pydub.AudioSegment.pan`."""
+    boost_factor = 2 ** (abs(pan) / 2)
+    reduce_factor = 2 - 2 ** abs(pan)
+    if pan < 0:
+        return boost_factor, reduce_factor
+    else:
+        return reduce_factor, boost_factor
+
+
+# (left, right) gains for every panning value in 1% steps
+PAN_LUT = np.array([get_pan_gains(pan / 100) for pan in range(-100, 101)])
+
+
+def get_channel_gains(gain: float, pan: float, channels: int) -> np.ndarray:
+    """Return the factors applying `gain` (in dB) and then `pan` to each channel,
+    so both are applied with a single multiplication. Mono samples are scaled by
+    the average of both channel gains."""
+    index = round(pan * 100)
+    if abs(pan * 100 - index) < 1e-9 and -100 <= index <= 100:
+        pan_gains = PAN_LUT[index + 100]
+    else:
+        pan_gains = np.array(get_pan_gains(pan))
+    if channels == 1:
+        pan_gains = pan_gains.mean(keepdims=True)
+    return (pan_gains * 10 ** (gain / 20)).astype("float32")
+
+
 def change_speed(sound: AudioSegment, speed: float = 1.0) -> AudioSegment:
-    if speed == 1.0:
+    if abs(speed - 1.0) < 1e-6:
         return sound
 
-    new = sound._spawn(
-        sound.raw_data, overrides={"frame_rate": round(sound.frame_rate * speed)}
-    )
-    return new.set_frame_rate(sound.frame_rate)
+    samples = get_samples(sound)
+    resampled = np.rint(resample(samples, speed)).astype(samples.dtype)
+    return sound._spawn(resampled.tobytes())
 
 
-def key_to_pitch(key: int) -> float:
+# Lookup tables for the integer keys and velocities used by most notes.
+# Keys are relative to F#4, and may be offset further by a custom instrument's pitch
+MIN_KEY = -90
+MAX_KEY = 87
+PITCH_LUT = 2.0 ** (np.arange(MIN_KEY, MAX_KEY + 1) / 12.0)
+DETUNE_LUT = 2.0 ** (np.arange(0, 100) / 1200.0)
+GAIN_STEPS = 10000  # Layer volume times note velocity, in 0.01% steps
+GAIN_LUT = np.log10(np.maximum(np.arange(0, GAIN_STEPS + 1) / GAIN_STEPS, 0.0001)) * 20
+
+
+def key_to_pitch(key: float) -> float:
+    cents = round(key * 100)
+    if abs(key * 100 - cents) < 1e-9:
+        semitone, detune = divmod(cents, 100)
+        if MIN_KEY <= semitone <= MAX_KEY:
+            return PITCH_LUT[semitone - MIN_KEY] * DETUNE_LUT[detune]
     return 2 ** ((key) / 12)
 
 
 def vol_to_gain(vol: float) -> float:
+    index = round(vol * GAIN_STEPS)
+    if abs(vol * GAIN_STEPS - index) < 1e-6 and 0 <= index <= GAIN_STEPS:
+        return GAIN_LUT[index]
     return math.log(max(vol, 0.0001), 10) * 20
 
 
@@ -51,75 +134,188 @@ class Mixer:
         self.sample_width = sample_width
         self.frame_rate = frame_rate
         self.channels = channels
-        self.output = np.zeros(self._get_array_size(length), dtype="int32")
-
-    def _get_array_size(self, length_in_ms: float) -> int:
-        frame_count = length_in_ms * (self.frame_rate / 1000.0)
-        array_size = frame_count * self.channels
-        array_size_aligned = self._get_aligned_array_size(array_size)
-        return array_size_aligned
+        self.output = np.zeros(
+            (self._get_frame_count(length), self.channels), dtype="int32"
+        )
 
-    def _get_aligned_array_size(self, length: int):
-        """Pads an array length to the appropriate data format."""
-        align = self.sample_width * self.channels
-        length_aligned = math.ceil(length / align) * align
-        return length_aligned
+    def _get_frame_count(self, length_in_ms: float) -> int:
+        """Return the number of frames needed to hold `length_in_ms` milliseconds."""
+        return math.ceil(length_in_ms * (self.frame_rate / 1000.0))
 
     def overlay(self, sound, position=0):
         sound_sync = self._sync(sound)
-        samples = np.frombuffer(sound_sync.get_array_of_samples(), dtype="int16")
-
-        frame_offset = int(self.frame_rate * position / 1000.0)
-        sample_offset = frame_offset * self.channels
+        samples = np.frombuffer(sound_sync.raw_data, dtype="int16").reshape(
+            -1, self.channels
+        )
+        return self.overlay_samples(samples, position)
 
-        start = sample_offset
+    def overlay_samples(self, samples: np.ndarray, position: float = 0):
+        """Mix an array of samples, shaped (frames, channels) and in this mixer's
+        format, into the output."""
+        start = int(self.frame_rate * position / 1000.0)
         end = start + len(samples)
 
-        output_size = len(self.output)
-        if end > output_size:
-            pad_length = self._get_aligned_array_size(end - output_size)
-            self.output = np.pad(
-                self.output, pad_width=(0, pad_length), mode="constant"
-            )
-            print(f"Padded from {output_size} to {end} (added {pad_length} entries)")
-
+        self._fit(end)
         self.output[start:end] += samples
 
         return self
 
+    def overlay_many(
+        self,
+        sounds: Sequence[np.ndarray],
+        sound_ids: np.ndarray,
+        positions: np.ndarray,
+    ):
+        """Mix `sounds[sound_ids[i]]` at `positions[i]` for every i. The start frames
+        are computed all at once, and the output is only resized once."""
+        starts = (self.frame_rate * positions / 1000.0).astype("int64")
+        lengths = np.array([len(sound) for sound in sounds], dtype="int64")
+        ends = starts + lengths[sound_ids]
+
+        if len(ends) > 0:
+            self._fit(ends.max())
+
+        # Sounds starting on the same frame form a chord. Chords that repeat
+        # are summed once and added as a whole at every start frame
+        chords = defaultdict(list)
+        for sound_id, start in zip(sound_ids.tolist(), starts.tolist()):
+            chords[start].append(sound_id)
+
+        chord_starts = defaultdict(list)
+        for start, chord in chords.items():
+            chord_starts[tuple(sorted(chord))].append(start)
+
+        output = self.output
+        for chord, frames in chord_starts.items():
+            if len(chord) > 1 and len(frames) > 1:
+                chord_sounds = [sounds[sound_id] for sound_id in chord]
+                chord_sound = np.zeros_like(max(chord_sounds, key=len))
+                for sound in chord_sounds:
+                    chord_sound[: len(sound)] += sound
+                chord_sounds = [chord_sound]
+            else:
+                chord_sounds = [sounds[sound_id] for sound_id in chord]
+
+            for start in frames:
+                for sound in chord_sounds:
+                    output[start : start + len(sound)] += sound
+
+        return self
+
+    def _fit(self, frame_count: int) -> None:
+        """Pad the output so it holds at least `frame_count` frames."""
+        output_size = len(self.output)
+        if frame_count > output_size:
+            pad_length = frame_count - output_size
+            self.output = np.pad(
+                self.output, pad_width=((0, pad_length), (0, 0)), mode="constant"
+            )
+            logger.debug(
+                "Padded from %d to %d (added %d frames)",
+                output_size,
+                frame_count,
+                pad_length,
+            )
+
     def _sync(self, segment: AudioSegment):
         return (
-            segment.set_sample_width(self.sample_width)
+            segment.set_sample_width(2)
             .set_frame_rate(self.frame_rate)
             .set_channels(self.channels)
         )
 
     def __len__(self):
-        return len(self.output) / ((self.frame_rate / 1000.0) * self.channels)
+        return int(len(self.output) / (self.frame_rate / 1000.0))
 
     def append(self, sound):
         self.overlay(sound, position=len(self))
 
     def to_audio_segment(self):
-        peak = np.abs(self.output).max()
+        # Finding the peak from the extremes avoids an absolute-value copy
+        peak = max(self.output.max(initial=0), -self.output.min(initial=0))
         clipping_factor = peak / (2**15 - 1)
 
         if clipping_factor > 1:
-            print(
-                f"The output is clipping by {clipping_factor:.2f}x. Normalizing to 0dBFS"
+            logger.info(
+                "The output is clipping by %.2fx. Normalizing to 0dBFS", clipping_factor
             )
-            normalized_signal = np.rint(self.output / clipping_factor).astype("int16")
+            normalized_signal = self.output / clipping_factor
+            np.rint(normalized_signal, out=normalized_signal)
         else:
             normalized_signal = self.output
 
-        output_segment = AudioSegment(
-            normalized_signal,
+        # Pack the accumulator to 16-bit samples once, at the very end. After
+        # normalizing, every sample is already within the 16-bit range
+        output_data = normalized_signal.astype("int16")
+
+        # Build the track straight from the mixed data, rather than copying it
+        # through an intermediate AudioSegment. The data is always 16-bit, like
+        # the instrument sounds; `Track.save` converts it to the requested width
+        return Track(
+            output_data.tobytes(),
             frame_rate=self.frame_rate,
-            sample_width=self.sample_width,
+            sample_width=2,
             channels=self.channels,
         )
 
-        return Track.from_audio_segment(output_segment)
+
+# ffmpeg input formats for the raw samples of each sample width
+PCM_FORMATS = {1: "s8", 2: "s16le", 3: "s24le", 4: "s32le"}
+
+
+def encode(
+    sound: AudioSegment,
+    filename: str,
+    format: str,
+    bitrate: Optional[str] = None,
+    tags: Optional[Dict[str, str]] = None,
+) -> None:
+    """Encode `sound` to `filename` by piping its raw samples straight into
+    ffmpeg, rather than through the temporary files used by `AudioSegment.export`."""
+    command = [
+        sound.converter,
+        "-y",
+        "-f",
+        PCM_FORMATS[sound.sample_width],
+        "-ar",
+        str(sound.frame_rate),
+        "-ac",
+        str(sound.channels),
+        "-i",
+        "pipe:0",
+    ]
+
+    codec = sound.DEFAULT_CODECS.get(format)
+    if codec is not None:
+        command.extend(["-acodec", codec])
+
+    if bitrate is not None:
+        command.extend(["-b:a", bitrate])
+
+    if tags:
+        for key, value in tags.items():
+            command.extend(["-metadata", f"{key}={value}"])
+        if format == "mp3":
+            command.extend(["-id3v2_version", "4"])
+
+    # Same as pydub: work around mp3 durations being misreported on macOS
+    if sys.platform == "darwin" and format == "mp3":
+        command.extend(["-write_xing", "0"])
+
+    command.extend(["-f", format, os.fspath(filename)])
+
+    process = subprocess.run(command, input=sound.raw_data, capture_output=True)
+    if process.returncode != 0:
+        # Don't leave a partially written file behind
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        raise CouldntEncodeError(
+            f"Encoding failed. ffmpeg returned error code: {process.returncode}\n\n"
+            f"Command: {command}\n\n"
+            f"Output from ffmpeg:\n\n{process.stderr.decode(errors='ignore')}"
+        )
 
 
 class Track(AudioSegment):
@@ -160,11 +356,15 @@ class Track(AudioSegment):
 
         output_segment = sync(self, channels, frame_rate, sample_width)
 
-        outfile = output_segment.export(
-            filename,
-            format=format,
-            bitrate="{}k".format(bitrate),
-            tags=tags,
-        )
-
-        outfile.close()
+        # Compressed formats are encoded straight from memory; WAV and raw data
+        # (or file-like outputs) are written by pydub without invoking ffmpeg
+        if format in ("wav", "raw") or not isinstance(filename, (str, os.PathLike)):
+            outfile = output_segment.export(
+                filename,
+                format=format,
+                bitrate="{}k".format(bitrate),
+                tags=tags,
+            )
+            outfile.close()
+        else:
+            encode(output_segment, filename, format, "{}k".format(bitrate), tags)
@@ -1,8 +1,12 @@
 import io
+import logging
 import os
 import zipfile
-from typing import BinaryIO, Dict, Sequence, Union
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from typing import BinaryIO, Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
+import numpy as np
 import pydub
 import pynbs
 
@@ -10,8 +14,20 @@ from . import audio, nbs
 
 __all__ = ["SongRenderer", "render_audio"]
 
+logger = logging.getLogger(__name__)
+
 SOUNDS_PATH = "sounds"
 
+# Maximum number of pitched sounds kept in memory per instrument while mixing
+PITCH_CACHE_SIZE = 64
+
+# Maximum size, in bytes, of the processed sounds held per instrument before
+# the notes using them are mixed
+SOUND_BATCH_BYTES = 64 * 2**20
+
+# Number of sound files decoded at the same time when loading instruments
+LOAD_WORKERS = 8
+
 DEFAULT_INSTRUMENTS = [
     "harp.ogg",
     "dbass.ogg",
@@ -39,13 +55,29 @@ class MissingInstrumentException(Exception):
     pass
 
 
-def load_default_instruments(path: PathLike) -> Dict[int, pydub.AudioSegment]:
-    segments = {}
-    for index, ins in enumerate(DEFAULT_INSTRUMENTS):
-        filename = os.path.join(os.getcwd(), path, ins)
-        sound = audio.load_sound(filename)
-        segments[index] = sound
-    return segments
+def _sync_instrument(sound: pydub.AudioSegment) -> pydub.AudioSegment:
+    """Convert an instrument sound to 16-bit stereo once, at load time. Its frame
+    rate is kept, as it's converted along with each note's pitch when mixing."""
+    return audio.sync(sound, frame_rate=sound.frame_rate)
+
+
+def _load_instrument(file: Union[PathLike, BinaryIO]) -> pydub.AudioSegment:
+    return _sync_instrument(audio.load_sound(file))
+
+
+def load_default_instruments(
+    path: PathLike, ids: Optional[Iterable[int]] = None
+) -> Dict[int, pydub.AudioSegment]:
+    """Load the default instrument sounds from `path`. If `ids` is given, only
+    the instruments with those IDs are loaded."""
+    if ids is None:
+        ids = range(len(DEFAULT_INSTRUMENTS))
+    ids = sorted(id for id in ids if 0 <= id < len(DEFAULT_INSTRUMENTS))
+    filenames = [os.path.join(os.getcwd(), path, DEFAULT_INSTRUMENTS[id]) for id in ids]
+
+    # Decoding is mostly spent waiting on ffmpeg, so sounds are loaded in threads
+    with ThreadPoolExecutor(max_workers=LOAD_WORKERS) as executor:
+        return dict(zip(ids, executor.map(_load_instrument, filenames)))
 
 
 def load_custom_instruments(
@@ -53,41 +85,164 @@ def load_custom_instruments(
 ) -> Dict[int, pydub.AudioSegment]:
     segments = {}
 
-    zip_file = None
-    for ins in song.instruments:
-        ins_id = ins.id + song.header.default_instruments
-
-        if ins.file == "":
-            print(f"Sound file for instrument {ins.name} wasn't assigned; skipping")
-            segments[ins_id] = None
-            continue
-
-        # ZipFile object
-        if isinstance(path, zipfile.ZipFile):
-            zip_file = path
-            file = io.BytesIO(zip_file.read(ins.file))
-        # File-like object
-        elif isinstance(path, str) and os.path.splitext(path)[1] == ".zip":
-            zip_file = zipfile.ZipFile(path, "r")
-            file = io.BytesIO(zip_file.read(ins.file))
-        # File path
-        else:
-            file = os.path.join(path, ins.file)
+    # Open the ZIP file once, rather than once for every instrument
+    if isinstance(path, zipfile.ZipFile):
+        zip_file = path
+    elif isinstance(path, (str, os.PathLike)) and os.fsdecode(path).endswith(".zip"):
+        zip_file = zipfile.ZipFile(os.fsdecode(path), "r")
+    elif hasattr(path, "read"):  # File-like object
+        zip_file = zipfile.ZipFile(path, "r")
+    else:
+        zip_file = None
+
+    with ThreadPoolExecutor(max_workers=LOAD_WORKERS) as executor:
+        futures = {}
+
+        for ins in song.instruments:
+            ins_id = ins.id + song.header.default_instruments
+
+            if ins.file == "":
+                logger.info(
+                    "Sound file for instrument %s wasn't assigned; skipping", ins.name
+                )
+                segments[ins_id] = None
+                continue
+
+            # ZIP file
+            if zip_file is not None:
+                file = io.BytesIO(zip_file.read(ins.file))
+            # File path
+            else:
+                file = os.path.join(os.fsdecode(path), ins.file)
 
-        try:
-            sound = audio.load_sound(file)
-        except FileNotFoundError:
-            print(f"Sound file for instrument {ins.file} couldn't be found; skipping")
-            continue
+            futures[ins_id] = (ins, executor.submit(_load_instrument, file))
 
-        segments[ins_id] = sound
+        for ins_id, (ins, future) in futures.items():
+            try:
+                segments[ins_id] = future.result()
+            except FileNotFoundError:
+                logger.warning(
+                    "Sound file for instrument %s couldn't be found; skipping",
+                    ins.file,
+                )
 
-    if zip_file is not None:
+    # Only close the file if it was opened here
+    if zip_file is not None and zip_file is not path:
         zip_file.close()
 
     return segments
 
 
+def _sort_order(
+    instruments: np.ndarray,
+    keys: np.ndarray,
+    velocities: np.ndarray,
+    pannings: np.ndarray,
+) -> np.ndarray:
+    """Return the indices that sort the notes by instrument, key, velocity and
+    panning. When every field fits, they are packed into one int64 per note,
+    which sorts faster than comparing the columns one by one."""
+    key_cents = np.rint(keys * 100).astype("int64") + 2**17
+    velocity_steps = np.rint(velocities * 10000).astype("int64")
+    pan_cents = np.rint(pannings * 100).astype("int64") + 100
+
+    # Fall back to sorting column by column if any field is out of range
+    fields = (
+        (instruments, 23),
+        (key_cents, 18),
+        (velocity_steps, 14),
+        (pan_cents, 8),
+    )
+    if len(instruments) == 0 or any(
+        values.min() < 0 or values.max() >= 2**bits for values, bits in fields
+    ):
+        return np.lexsort((pannings, velocities, keys, instruments))
+
+    packed = instruments << 40 | key_cents << 22 | velocity_steps << 8 | pan_cents
+    return np.argsort(packed, kind="stable")
+
+
+def _render_instrument(
+    samples: np.ndarray,
+    frame_rate: int,
+    keys: np.ndarray,
+    gains: np.ndarray,
+    pannings: np.ndarray,
+    positions: np.ndarray,
+    sample_rate: int,
+    channels: int,
+    bit_depth: int,
+    length: float,
+    mixer: Optional[audio.Mixer] = None,
+) -> np.ndarray:
+    """Mix all notes played by a single instrument, given as columns of keys, gains,
+    pannings and positions, and return the mixed samples. `samples` holds the
+    instrument sound, with the mixer's channel count, at `frame_rate`. If `mixer`
+    is given, the notes are mixed into it instead of a new buffer."""
+
+    if mixer is None:
+        mixer = audio.Mixer(
+            sample_width=bit_depth // 8,
+            frame_rate=sample_rate,
+            channels=channels,
+            length=length,
+        )
+
+    # Converting the sound to the mixer's frame rate is folded into the pitch change
+    rate_ratio = frame_rate / sample_rate
+
+    # Pitched sounds are shared by all notes that only differ in volume or panning
+    @lru_cache(maxsize=PITCH_CACHE_SIZE)
+    def get_pitched_samples(key: float) -> np.ndarray:
+        semitone = round(key)
+        detune = key - semitone
+        if abs(detune) > 1e-3:
+            return audio.resample(
+                get_pitched_samples(semitone), audio.key_to_pitch(detune)
+            )
+        return audio.resample(samples, audio.key_to_pitch(semitone) * rate_ratio)
+
+    # Notes in a song repeat the same (key, volume, panning) combination
+    # very often, so each processed sound is only rendered once
+    sounds: List[np.ndarray] = []
+    sounds_size = 0
+    sound_cache: Dict[Tuple[float, float, float], int] = {}
+    sound_ids = np.empty(len(keys), dtype="int64")
+    batch_start = 0
+
+    note_data = zip(keys.tolist(), gains.tolist(), pannings.tolist())
+    for i, (key, gain, pan) in enumerate(note_data):
+        sound_id = sound_cache.get((key, gain, pan))
+
+        # Mix the notes processed so far once their sounds reach the size limit,
+        # so the memory held by processed sounds stays bounded
+        if sound_id is None and sounds_size >= SOUND_BATCH_BYTES:
+            batch = slice(batch_start, i)
+            mixer.overlay_many(sounds, sound_ids[batch], positions[batch])
+            sounds.clear()
+            sounds_size = 0
+            sound_cache.clear()
+            batch_start = i
+
+        if sound_id is None:
+            pitched_samples = get_pitched_samples(key)
+            channel_gains = audio.get_channel_gains(gain, pan, channels)
+            note_samples = pitched_samples * channel_gains
+            np.rint(note_samples, out=note_samples)
+            sound_id = len(sounds)
+            sounds.append(note_samples.astype("int32"))
+            sounds_size += sounds[-1].nbytes
+            sound_cache[(key, gain, pan)] = sound_id
+
+        sound_ids[i] = sound_id
+
+    # The remaining notes are mixed in one batch once their sounds are ready
+    batch = slice(batch_start, len(keys))
+    mixer.overlay_many(sounds, sound_ids[batch], positions[batch])
+
+    return mixer.output
+
+
 class SongRenderer:
     def __init__(
         self,
@@ -97,10 +252,30 @@ class SongRenderer:
         if isinstance(song, pynbs.File):
             song = nbs.Song(song)
         self._song = song
-        self._instruments = load_default_instruments(default_sound_path)
+        # Only the default instruments played in the song are decoded
+        used_instruments = {
+            note.instrument
+            for note in song.notes
+            if note.instrument < song.header.default_instruments
+        }
+        self._instruments = load_default_instruments(
+            default_sound_path, used_instruments
+        )
+        self._samples: Dict[Tuple[int, int], np.ndarray] = {}
 
     def load_instruments(self, path: ZipFileOrPath):
         self._instruments.update(load_custom_instruments(self._song, path))
+        self._samples.clear()
+
+    def _get_samples(self, instrument: int, channels: int) -> np.ndarray:
+        """Return the samples of an instrument's sound with the given number of
+        channels. They're kept so that every mix (e.g. each layer) can share them."""
+        key = (instrument, channels)
+        if key not in self._samples:
+            # Instruments are already stereo, so this is only a copy for mono mixes
+            sound = self._instruments[instrument].set_channels(channels)
+            self._samples[key] = audio.get_samples(sound)
+        return self._samples[key]
 
     def missing_instruments(self):
         return [
@@ -116,20 +291,26 @@ class SongRenderer:
         note to stop ringing.
         """
 
-        def get_note_end_time(note: nbs.Note) -> float:
-
-            note_start = tempo_segments[note.tick]
-            sound = self._instruments.get(note.instrument)
-
-            if sound is None:  # Sound either missing or not assigned
-                return note_start
-            else:
-                note_pitch = audio.key_to_pitch(note.key)
-                note_length = len(sound) / note_pitch
-                note_end = note_start + note_length
-                return note_end
+        notes = list(notes)
+        ticks = np.fromiter((note.tick for note in notes), "int64", len(notes))
+        instruments = np.fromiter(
+            (note.instrument for note in notes), "int64", len(notes)
+        )
+        keys = np.fromiter((note.key for note in notes), "float64", len(notes))
+
+        # The length of each instrument's sound is looked up once, rather than
+        # once per note. Missing or unassigned sounds don't ring at all
+        sound_lengths = {
+            ins: len(sound) if sound is not None else 0
+            for ins, sound in self._instruments.items()
+        }
+        note_lengths = np.array(
+            [sound_lengths.get(ins, 0) for ins in instruments.tolist()], dtype=float
+        )
 
-        return max(get_note_end_time(note) for note in notes)
+        note_starts = np.asarray(tempo_segments)[ticks]
+        note_ends = note_starts + note_lengths / 2 ** (keys / 12)
+        return float(note_ends.max())
 
     def _mix(
         self,
@@ -138,6 +319,7 @@ class SongRenderer:
         sample_rate: int = 44100,
         channels: int = 2,
         bit_depth: int = 16,
+        workers: Optional[int] = 1,
     ) -> audio.Track:
 
         tempo_segments = self._song.tempo_segments
@@ -150,67 +332,89 @@ class SongRenderer:
             length=track_length,
         )
 
-        sorted_notes = nbs.sorted_notes(notes)
-
-        last_ins = None
-        last_key = None
-        last_vol = None
-        last_pan = None
-
-        for note in sorted_notes:
-
-            ins = note.instrument
-            key = note.key
-            vol = note.velocity
-            pan = note.panning
-
-            if ins != last_ins:
-                last_key = None
-                last_vol = None
-                last_pan = None
-
-                try:
-                    sound1 = self._instruments[note.instrument]
-                except KeyError:  # Sound file missing
-                    if not ignore_missing_instruments:
-                        custom_ins_id = ins - self._song.header.default_instruments
-                        instrument_data = self._song.instruments[custom_ins_id]
-                        ins_name = instrument_data.name
-                        ins_file = instrument_data.file
-                        raise MissingInstrumentException(
-                            f"The sound file for instrument {ins_name} was not found: {ins_file}"
-                        )
-                    else:
-                        continue
-
-                if sound1 is None:  # Sound file not assigned
+        notes = list(notes)
+
+        # Extract the note properties into columns once, so the values used for
+        # rendering can be derived with vectorized operations
+        def get_column(attr: str, dtype: str) -> np.ndarray:
+            values = (getattr(note, attr) for note in notes)
+            return np.fromiter(values, dtype=dtype, count=len(notes))
+
+        instruments = get_column("instrument", "int64")
+        ticks = get_column("tick", "int64")
+        keys = np.round(get_column("key", "float64"), 2)
+        velocities = get_column("velocity", "float64")
+        pannings = np.round(get_column("panning", "float64"), 2)
+
+        # Group notes sharing the same sound together (see `nbs.NOTE_SORT_KEY`)
+        order = _sort_order(instruments, keys, velocities, pannings)
+        instruments = instruments[order]
+        ticks = ticks[order]
+        keys = keys[order]
+        pannings = pannings[order]
+
+        volumes, volume_ids = np.unique(velocities[order], return_inverse=True)
+        gains = np.array([audio.vol_to_gain(vol) for vol in volumes])[volume_ids]
+        gains = np.round(gains * 2) / 2  # 0.5 dB steps
+        positions = np.asarray(tempo_segments)[ticks]
+
+        # Each instrument is rendered into its own buffer, so they can be
+        # rendered in parallel and summed afterwards. Since the notes are sorted
+        # by instrument, each instrument's notes are a contiguous range
+        instrument_ids, starts = np.unique(instruments, return_index=True)
+        ends = np.append(starts[1:], len(instruments))
+
+        instrument_jobs = []
+        for ins, start, end in zip(instrument_ids.tolist(), starts, ends):
+            try:
+                sound = self._instruments[ins]
+            except KeyError:  # Sound file missing
+                if not ignore_missing_instruments:
+                    custom_ins_id = ins - self._song.header.default_instruments
+                    instrument_data = self._song.instruments[custom_ins_id]
+                    ins_name = instrument_data.name
+                    ins_file = instrument_data.file
+                    raise MissingInstrumentException(
+                        f"The sound file for instrument {ins_name} was not found: {ins_file}"
+                    )
+                else:
                     continue
 
-                sound1 = audio.sync(sound1)
-
-            if key != last_key:
-                last_vol = None
-                last_pan = None
-                pitch = audio.key_to_pitch(key)
-                sound2 = audio.change_speed(sound1, pitch)
-
-            if vol != last_vol:
-                last_pan = None
-                gain = audio.vol_to_gain(vol)
-                sound3 = sound2.apply_gain(gain)
-
-            if pan != last_pan:
-                sound4 = sound3.pan(pan)
-                sound = sound4
-
-            last_ins = ins
-            last_key = key
-            last_vol = vol
-            last_pan = pan
-
-            pos = tempo_segments[note.tick]
-
-            mixer.overlay(sound, position=pos)
+            if sound is None:  # Sound file not assigned
+                continue
+
+            samples = self._get_samples(ins, channels)
+
+            instrument_jobs.append(
+                (
+                    samples,
+                    sound.frame_rate,
+                    keys[start:end],
+                    gains[start:end],
+                    pannings[start:end],
+                    positions[start:end],
+                    sample_rate,
+                    channels,
+                    bit_depth,
+                    track_length,
+                )
+            )
+
+        def log_progress(count: int) -> None:
+            logger.info("Rendered %d/%d instruments", count, len(instrument_jobs))
+
+        if workers == 1:
+            # Rendering one instrument at a time, every instrument can be mixed
+            # straight into the song's buffer rather than a buffer of its own
+            for count, job in enumerate(instrument_jobs, start=1):
+                _render_instrument(*job, mixer=mixer)
+                log_progress(count)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                outputs = executor.map(_render_instrument, *zip(*instrument_jobs))
+                for count, output in enumerate(outputs, start=1):
+                    mixer.overlay_samples(output)
+                    log_progress(count)
 
         return mixer.to_audio_segment()
 
@@ -231,9 +435,9 @@ class SongRenderer:
             **kwargs,
         )
 
-    def mix_layers(self):
-        for id, notes in self._song.notes_by_layer():
-            yield self._mix(notes)
+    def mix_layers(self, **kwargs):
+        for id, notes in self._song.notes_by_layer().items():
+            yield self._mix(notes, **kwargs)
 
 
 def render_audio(
@@ -254,6 +458,8 @@ def render_audio(
     headroom: float = 3.0,
     ignore_missing_instruments: bool = False,
     exclude_locked_layers: bool = False,
+    workers: Optional[int] = 1,
+    internal_sample_rate: Optional[int] = None,
 ) -> None:
     song = pynbs.read(song_path)
     renderer = SongRenderer(song, default_sound_path)
@@ -261,9 +467,11 @@ def render_audio(
     renderer.mix_song(
         ignore_missing_instruments,
         exclude_locked_layers,
-        sample_rate=sample_rate,
+        # Mixing at a lower rate is faster; the track is resampled on export
+        sample_rate=internal_sample_rate or sample_rate,
         bit_depth=bit_depth,
         channels=channels,
+        workers=workers,
     ).save(
         output_path,
         format,
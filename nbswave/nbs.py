@@ -1,14 +1,25 @@
 from __future__ import annotations
 
-from typing import Dict, Iterator, List, Optional, Sequence, Union
-
+import copy
+import dataclasses
+from collections import defaultdict
+from functools import lru_cache
+from operator import attrgetter
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
 import pynbs
 
+NOTE_SORT_KEY = attrgetter("instrument", "key", "velocity", "panning")
+
+# Maximum number of distinct note and layer value combinations to keep weighted
+LAYER_WEIGHT_CACHE_SIZE = 65536
+
 
 def sorted_notes(notes: Sequence[Note]) -> List[Note]:
-    """Return a list of notes sorted by pitch, instrument, velocity, and
-    panning."""
-    return sorted(notes, key=lambda x: (x.pitch, x.instrument, x.velocity, x.panning))
+    """Return a list of notes sorted by instrument, key, velocity, and
+    panning, so that notes sharing the same sound are grouped together."""
+    return sorted(notes, key=NOTE_SORT_KEY)
 
 
 class Note(pynbs.Note):
@@ -26,6 +37,25 @@ class Note(pynbs.Note):
             note.pitch,
         )
 
+    @classmethod
+    def _from_fields(
+        cls,
+        tick: int,
+        layer: int,
+        instrument: int,
+        key: float,
+        velocity: float = 100,
+        panning: float = 0,
+        pitch: float = 0,
+    ) -> Note:
+        """Create a note directly from its field values, without copying them from
+        an intermediate note object."""
+        note = cls.__new__(cls)
+        pynbs.Note.__init__(
+            note, tick, layer, instrument, key, velocity, panning, pitch
+        )
+        return note
+
     def move(self, offset: int) -> Note:
         """Return this note moved by a certain amount of ticks."""
         new_note = Note(self)
@@ -36,40 +66,58 @@ class Note(pynbs.Note):
         self, layer: pynbs.Layer, custom_instrument: Optional[pynbs.Instrument] = None
     ) -> Note:
         """Return a new Note object with compensated pitch, volume and panning."""
-        pitch = self._get_pitch(custom_instrument)
-        volume = self._get_volume(layer)
-        panning = self._get_panning(layer)
-        return self.__class__(
-            pynbs.Note(self.tick, self.layer, self.instrument, pitch, volume, panning)
+        instrument_pitch = (
+            custom_instrument.pitch if custom_instrument is not None else None
+        )
+        pitch, volume, panning = _layer_weight(
+            self.key,
+            self.velocity,
+            self.panning,
+            self.pitch,
+            layer.volume,
+            layer.panning,
+            instrument_pitch,
+        )
+        return self._from_fields(
+            self.tick, self.layer, self.instrument, pitch, volume, panning
         )
 
-    def _get_pitch(self, custom_instrument: Optional[pynbs.Instrument] = None) -> float:
-        """Return the detune-aware pitch of this note."""
-        if custom_instrument is not None:
-            instrument_key = (45 - custom_instrument.pitch) + 45
-        else:
-            instrument_key = 45  # This assumes all default instruments are pitched F#4
-        key = self.key - instrument_key
-        detune = self.pitch / 100
-        pitch = key + detune
-        return pitch
-
-    def _get_volume(self, layer: pynbs.Layer) -> float:
-        """Return the layer-aware volume of this note."""
-        layer_vol = layer.volume / 100
-        note_vol = self.velocity / 100
-        vol = layer_vol * note_vol
-        return vol
-
-    def _get_panning(self, layer: pynbs.Layer) -> float:
-        """Return the layer-aware panning of this note."""
-        layer_pan = layer.panning / 100
-        note_pan = self.panning / 100
-        if layer_pan == 0:
-            pan = note_pan
-        else:
-            pan = (layer_pan + note_pan) / 2
-        return pan
+
+# Songs repeat the same note and layer values very often, so the compensated
+# values are computed once for each combination
+@lru_cache(maxsize=LAYER_WEIGHT_CACHE_SIZE)
+def _layer_weight(
+    key: int,
+    velocity: int,
+    panning: int,
+    pitch: int,
+    layer_volume: int,
+    layer_panning: int,
+    instrument_pitch: Optional[int] = None,
+) -> Tuple[float, float, float]:
+    """Return the detune-aware pitch, and the layer-aware volume and panning, of a
+    note with the given values."""
+    if instrument_pitch is not None:
+        instrument_key = (45 - instrument_pitch) + 45
+    else:
+        instrument_key = 45  # This assumes all default instruments are pitched F#4
+    note_key = key - instrument_key
+    if pitch != 0:
+        note_key += pitch / 100  # Detune; the common case is kept an integer
+
+    if layer_volume == 100 and velocity == 100:
+        volume = 1.0
+    else:
+        volume = (layer_volume / 100) * (velocity / 100)
+
+    layer_pan = layer_panning / 100
+    note_pan = panning / 100
+    if layer_pan == 0:
+        pan = note_pan
+    else:
+        pan = (layer_pan + note_pan) / 2
+
+    return note_key, volume, pan
 
 
 class Song(pynbs.File):
@@ -83,33 +131,25 @@ class Song(pynbs.File):
         """Return the length of the song, in ticks."""
         if self.header.version in (1, 2):
             # Length isn't correct in version 1 and 2 songs, so we need this workaround
-            length = max((note.tick for note in self.notes))
-        else:
-            length = self.header.song_length
-        return length
+            return max((note.tick for note in self.notes), default=0)
+        return self.header.song_length
 
     def __getitem__(self, key: Union[int, slice]) -> List[Note]:
         """Return the notes in a certain section (vertical slice) of the song."""
         if isinstance(key, int):
-            section = [note for note in self.notes if note.tick == key]
+            return [note for note in self.notes if note.tick == key]
         elif isinstance(key, slice):
             start = key.start if key.start is not None else 0
-            stop = key.stop if key.stop is not None else len(self)
-            section = [
-                note for note in self.notes if note.tick > start and note.tick < stop
-            ]
+            if key.stop is None:
+                return [note for note in self.notes if note.tick >= start]
+            return [note for note in self.notes if start <= note.tick < key.stop]
         else:
             raise TypeError("Index must be an integer")
-        return list(section)
 
     @property
-    def duration(self) -> int:
-        """The duration of the song, in seconds."""
-        return self._duration
-
-    @duration.getter
-    def duration(self) -> None:
-        self._duration = len(self) / self.header.tempo * 1000
+    def duration(self) -> float:
+        """The duration of the song, in milliseconds."""
+        return len(self) / self.header.tempo * 1000
 
     @property
     def tempo_changer_ids(self) -> List[int]:
@@ -126,8 +166,8 @@ class Song(pynbs.File):
     @property
     def has_tempo_changers(self) -> bool:
         """Return true if this song contains any tempo changes."""
-        tc_ids = self.tempo_changer_ids
-        return tc_ids != [] and any(note.instrument in tc_ids for note in self.notes)
+        tc_ids = set(self.tempo_changer_ids)
+        return bool(tc_ids) and any(note.instrument in tc_ids for note in self.notes)
 
     @property
     def tempo_segments(self) -> List[float]:
@@ -135,30 +175,29 @@ class Song(pynbs.File):
         Return a list with the same length as the number of ticks in the song,
         where each value is the point in milliseconds where that tick is played.
         """
-        tc_ids = self.tempo_changer_ids
+        tc_ids = set(self.tempo_changer_ids)
         tempo_change_blocks = [note for note in self.notes if note.instrument in tc_ids]
         tempo_change_blocks.sort(key=lambda x: x.tick)
         current_tick = 0
         current_tempo = self.header.tempo
-        tempo_segments = []
-        millis = 0
+        # The number of ticks in each section of constant tempo, and their duration
+        tick_counts = []
+        tick_durations = []
         for note in tempo_change_blocks:
             # Edge case: if there are multiple tempo changers in the same tick,
-            # the following will be a no-op, so only the first is considered
-            for tick in range(current_tick, note.tick):
-                millis += 1 / current_tempo * 1000
-                tempo_segments.append(millis)
+            # the following will be an empty section, so only the last is considered
+            tick_counts.append(note.tick - current_tick)
+            tick_durations.append(1 / current_tempo * 1000)
             current_tick = note.tick
             current_tempo = (
                 note.pitch / 15
             )  # The note pitch is the new BPM of the song (t/s = BPM / 15)
 
         # Fill the remainder of the song (after the last tempo changer)
-        for tick in range(current_tick, len(self) + 1):
-            millis += 1 / current_tempo * 1000
-            tempo_segments.append(millis)
+        tick_counts.append(max(len(self) + 1 - current_tick, 0))
+        tick_durations.append(1 / current_tempo * 1000)
 
-        return tempo_segments
+        return np.cumsum(np.repeat(tick_durations, tick_counts)).tolist()
 
     def get_layer(self, id: int) -> pynbs.Layer:
         """Return the layer with the given ID."""
@@ -179,41 +218,52 @@ class Song(pynbs.File):
                 instrument = None
             yield note.apply_layer_weight(layer, instrument)
 
-    def layer_groups(self) -> Dict[str, pynbs.Layer]:
+    def layer_groups(self) -> Dict[str, List[int]]:
         """Return a dict containing each unique layer name in this song and a list
-        of all layers with that name."""
-        groups = {}
+        of the IDs of all layers with that name."""
+        groups = defaultdict(list)
         for layer in self.layers:
-            name = layer.name
-            if name not in groups:
-                groups[name] = []
-            else:
-                groups[name].append(layer.id)
-        return groups
+            groups[layer.name].append(layer.id)
+        return dict(groups)
 
     def notes_by_layer(self, group_by_name: bool = False) -> Dict[str, List[Note]]:
         """Return a dict of lists containing the weighted notes in each non-empty layer of the
         song. If `group_by_name` is true, notes in layers with identical names will be grouped."""
-        groups = {}
+        groups = defaultdict(list)
+        group_names = {}  # The group name of each layer, built once per layer
         for note in self.weighted_notes():
-            layer = self.get_layer(note.layer)
-            group_name = layer.name if group_by_name else f"{layer.id} {layer.name}"
-            if group_name not in groups:
-                groups[group_name] = []
+            group_name = group_names.get(note.layer)
+            if group_name is None:
+                layer = self.get_layer(note.layer)
+                group_name = layer.name if group_by_name else f"{layer.id} {layer.name}"
+                group_names[note.layer] = group_name
             groups[group_name].append(note)
-        return groups
+        return dict(groups)
 
     def loop(self, count: int, start: Optional[int] = None) -> Song:
         """Return this song looped `count` times with an optional loop start tick (`start`).
         If `start` is not provided, defaults to the start tick defined in the song)."""
         if start is None:
-            start = self.header.loop_start_tick
-        notes = self[start:]
-        new_song = self
+            start = self.header.loop_start
+        length = len(self)
+        if start > length:
+            raise ValueError(
+                f"Loop start tick ({start}) is past the end of the song ({length})"
+            )
+        # The length is the index of the last tick, so the loop section includes it
+        loop_length = length - start + 1
+        loop_notes = self[start:]
+
+        notes = [Note(note) for note in self.notes]
         for i in range(1, count):
-            offset = (len(self) - start) * i
-            notes = (note.move_note(note, offset) for note in self.notes)
-            new_song.notes.extend(notes)
+            offset = loop_length * i
+            notes.extend(note.move(offset) for note in loop_notes)
+
+        new_song = copy.copy(self)
+        new_song.header = dataclasses.replace(
+            self.header, song_length=length + loop_length * max(count - 1, 0)
+        )
+        new_song.notes = notes
         return new_song
 
     def get_locked_layers(self) -> List[int]:
@@ -222,12 +272,14 @@ class Song(pynbs.File):
 
     def get_unlocked_notes(self) -> Iterator[Note]:
         """Return all notes in this song whose layers are not locked."""
-        locked_layers = self.get_locked_layers()
+        locked_layers = set(self.get_locked_layers())
         return (
             note for note in self.weighted_notes() if note.layer not in locked_layers
         )
 
     def sorted_notes(self) -> List[Note]:
-        """Return the notes in this song sorted by pitch, instrument, velocity, and
-        panning."""
-        return sorted_notes(self.notes)
+        """Return the weighted notes in this song sorted by instrument, key, velocity,
+        and panning."""
+        notes = list(self.weighted_notes())
+        notes.sort(key=NOTE_SORT_KEY)
+        return notes